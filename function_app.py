@@ -1,12 +1,19 @@
+import io
 import os
-import json
-import re
-import requests
+import time
+import asyncio
+import threading
+from functools import lru_cache
+import httpx
+import ijson
+import orjson
+from tenacity import (
+    AsyncRetrying, retry_if_exception_type, stop_after_attempt, stop_after_delay, wait_exponential_jitter
+)
 from datetime import datetime, timezone, tzinfo, timedelta
 
 import azure.functions as func
 from azure.functions import FunctionApp
-from msal import ConfidentialClientApplication
 
 # ---- Robust Calgary timezone loader ----
 def _load_calgary_tz() -> tzinfo:
@@ -37,6 +44,68 @@ CALGARY_TZ = _load_calgary_tz()
 
 app = FunctionApp()
 
+# Shared async HTTP client: reused across invocations so Dataverse connections stay pooled
+HTTP_CLIENT = httpx.AsyncClient(
+    http2=True,
+    # httpx defaults to 5s; large month queries take longer than that
+    timeout=httpx.Timeout(120.0, connect=10.0),
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    headers={
+        "Accept": "application/json",
+        "OData-MaxVersion": "4.0",
+        "OData-Version": "4.0",
+        "Prefer": "odata.maxpagesize=5000"
+    }
+)
+
+# Dataverse throttling / transient gateway statuses worth retrying
+_RETRY_STATUSES = (429, 502, 503, 504)
+_BACKOFF = wait_exponential_jitter(initial=1, max=30)
+# Longest Retry-After we will sleep for, and the total retry budget per request;
+# both keep an invocation well inside the ~230s HTTP front-end timeout
+_RETRY_AFTER_CAP = 30
+_RETRY_BUDGET = 90
+_STOP = stop_after_attempt(5) | stop_after_delay(_RETRY_BUDGET)
+
+# Admissions query options, with $expand=cp_Client and the opioid agonist therapy substance
+_ADMISSIONS_SELECT = ",".join([
+    "cp_servicerequestdate",
+    "cp_admissiondate",
+    "cp_actualdischargedate",
+    "cp_primarysubstanceused",
+    "cp_othersubstances",
+    "cp_contributingfactors",
+    "cp_incomesource",
+    "cp_reasonfordischargemdrate",
+    "cp_reasonforhospitaladmissionmdrate",
+    "cp_postdischargereferral",
+    "cp_detoxtype",
+    "cp_medicaldischargedate",
+    "cp_pseudoname"
+])
+_CONTACT_SELECT = ",".join([
+    "cp_ahcnumber",
+    "cp_clientoutofprovince",
+    "address1_postalcode",
+    "cp_gender",
+    "cp_age",
+    "cp_mrpnumber"
+])
+_EXPAND = f"cp_Client($select={_CONTACT_SELECT}),cp_OpioidAgonistTherapy($select=cp_nameofsubstance)"
+
+_STRFMT = "%m/%d/%Y %I:%M %p"
+
+# Choice/Yes-No labels by entity and attribute logical name, cached per worker process
+# instead of asking Dataverse to annotate every row with FormattedValue; reloaded after
+# the TTL so options added by an admin show up without a worker restart
+_OPTION_LABELS_TTL = 15 * 60
+_OPTION_LABELS = {"labels": None, "loaded_at": 0.0}
+
+# MSAL app and bearer token, kept for the lifetime of the worker process
+_AUTH_LOCK = threading.Lock()
+_CCA = None
+_TOKEN = {"access_token": None, "expires_at": 0.0}
+
 # ----------------- Helpers -----------------
 
 def last_month_bounds_utc(now_utc: datetime):
@@ -52,6 +121,47 @@ def last_month_bounds_utc(now_utc: datetime):
     last_end = this_month_start
     return last_start.strftime("%Y-%m-%dT%H:%M:%SZ"), last_end.strftime("%Y-%m-%dT%H:%M:%SZ")
 
+def month_bounds_utc(now_utc: datetime):
+    """
+    Return UTC (Z) bounds for the current calendar month:
+    [start_of_this_month, start_of_next_month)
+    """
+    this_start = now_utc.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if this_start.month == 12:
+        next_start = this_start.replace(year=this_start.year + 1, month=1)
+    else:
+        next_start = this_start.replace(month=this_start.month + 1)
+    return this_start.strftime("%Y-%m-%dT%H:%M:%SZ"), next_start.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# ?period= values accepted by GetMDRATE; "last" is the default
+PERIOD_BOUNDS = {
+    "last": last_month_bounds_utc,
+    "current": month_bounds_utc
+}
+
+def acquire_token(tenant_id: str, client_id: str, client_secret: str, dataverse_url: str) -> dict:
+    """
+    Return an MSAL token result for Dataverse, reusing the cached token until
+    60s before expiry. Blocking; call off the event loop.
+    """
+    global _CCA
+    with _AUTH_LOCK:
+        if _TOKEN["access_token"] and time.time() < _TOKEN["expires_at"] - 60:
+            return {"access_token": _TOKEN["access_token"]}
+        if _CCA is None:
+            # Imported on first cache miss to keep msal off the cold-start import path
+            from msal import ConfidentialClientApplication
+            _CCA = ConfidentialClientApplication(
+                client_id,
+                authority=f"https://login.microsoftonline.com/{tenant_id}",
+                client_credential=client_secret
+            )
+        result = _CCA.acquire_token_for_client(scopes=[f"{dataverse_url}/.default"])
+        if "access_token" in result:
+            _TOKEN["access_token"] = result["access_token"]
+            _TOKEN["expires_at"] = time.time() + int(result.get("expires_in", 0))
+        return result
+
 def fmt_cell(val, na="NA"):
     if val is None or val == "":
         return na
@@ -61,20 +171,128 @@ def fmt_cell(val, na="NA"):
         return str(val)
     return str(val)
 
-def get_value(obj, field):
-    if not obj:
-        return ""
-    fmt_key = f"{field}@OData.Community.Display.V1.FormattedValue"
-    if fmt_key in obj and obj[fmt_key] not in (None, ""):
-        return obj[fmt_key]
-    return obj.get(field, "")
+class _RetryableStatus(Exception):
+    def __init__(self, response: httpx.Response):
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+
+def _retry_after(retry_state):
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, _RetryableStatus):
+        retry_after = exc.response.headers.get("Retry-After", "").strip()
+        if retry_after.isdigit():
+            return float(retry_after)
+    return None
 
-def sanitize_guid(g):
-    if not g:
+def _retry_stop(retry_state) -> bool:
+    # Give up at once when Dataverse asks for a wait we cannot afford
+    retry_after = _retry_after(retry_state)
+    if retry_after is not None and (
+        retry_after > _RETRY_AFTER_CAP
+        or retry_state.seconds_since_start + retry_after > _RETRY_BUDGET
+    ):
+        return True
+    return _STOP(retry_state)
+
+def _retry_wait(retry_state) -> float:
+    # Honor Dataverse's Retry-After (seconds) on throttling, else back off exponentially
+    retry_after = _retry_after(retry_state)
+    if retry_after is not None:
+        return min(retry_after, _RETRY_AFTER_CAP)
+    return _BACKOFF(retry_state)
+
+async def send_with_retry(request: httpx.Request, stream: bool = False) -> httpx.Response:
+    """
+    Send a Dataverse request, retrying transport errors and 429/502/503/504 up to 5 attempts
+    within _RETRY_BUDGET seconds. Returns the last response once retries are exhausted or a
+    Retry-After exceeds the budget; transport errors are re-raised.
+    """
+    try:
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type((httpx.TransportError, _RetryableStatus)),
+            wait=_retry_wait,
+            stop=_retry_stop,
+            reraise=True
+        ):
+            with attempt:
+                resp = await HTTP_CLIENT.send(request, stream=stream)
+                if resp.status_code in _RETRY_STATUSES:
+                    # Read the body so the connection is released and resp.text stays usable
+                    await resp.aread()
+                    raise _RetryableStatus(resp)
+    except _RetryableStatus as e:
+        return e.response
+    return resp
+
+async def load_option_labels(dataverse_url: str, headers: dict) -> dict:
+    """
+    Fetch choice, multi-select choice and Yes/No labels for admissions and contacts,
+    reusing the cached copy for _OPTION_LABELS_TTL seconds.
+    Returns {entity: {attribute: {value: label}}}; raises RuntimeError on a failed query.
+    """
+    if _OPTION_LABELS["labels"] is not None and time.time() < _OPTION_LABELS["loaded_at"] + _OPTION_LABELS_TTL:
+        return _OPTION_LABELS["labels"]
+
+    base = f"{dataverse_url}/api/data/v9.2/EntityDefinitions"
+    queries = []
+    for entity in ("cp_cp_admission", "contact"):
+        for kind in ("PicklistAttributeMetadata", "MultiSelectPicklistAttributeMetadata"):
+            queries.append((
+                entity,
+                f"{base}(LogicalName='{entity}')/Attributes/Microsoft.Dynamics.CRM.{kind}",
+                {"$select": "LogicalName", "$expand": "OptionSet($select=Options),GlobalOptionSet($select=Options)"}
+            ))
+        queries.append((
+            entity,
+            f"{base}(LogicalName='{entity}')/Attributes/Microsoft.Dynamics.CRM.BooleanAttributeMetadata",
+            {"$select": "LogicalName", "$expand": "OptionSet($select=TrueOption,FalseOption)"}
+        ))
+    responses = await asyncio.gather(
+        *(send_with_retry(HTTP_CLIENT.build_request("GET", url, headers=headers, params=params))
+          for _, url, params in queries)
+    )
+
+    def label_of(option):
+        # UserLocalizedLabel can be null (e.g. no label in the caller's language)
+        label = (option or {}).get("Label") or {}
+        localized = label.get("UserLocalizedLabel") or next(iter(label.get("LocalizedLabels") or []), None)
+        return (localized or {}).get("Label") or None
+
+    def label_map(pairs):
+        # Values without any label are left out so get_value falls back to the raw value
+        return {value: text for value, text in pairs if text}
+
+    labels = {}
+    for (entity, _, _), r in zip(queries, responses):
+        if r.status_code != 200:
+            raise RuntimeError(f"Dataverse metadata query failed: {r.text}")
+        entity_labels = labels.setdefault(entity, {})
+        for attr in orjson.loads(r.content).get("value", []):
+            opts = attr.get("OptionSet") or attr.get("GlobalOptionSet") or {}
+            if "Options" in opts:
+                entity_labels[attr["LogicalName"]] = label_map(
+                    (o["Value"], label_of(o)) for o in opts["Options"]
+                )
+            elif "TrueOption" in opts:
+                entity_labels[attr["LogicalName"]] = label_map((
+                    (True, label_of(opts["TrueOption"])),
+                    (False, label_of(opts["FalseOption"]))
+                ))
+    _OPTION_LABELS["labels"] = labels
+    _OPTION_LABELS["loaded_at"] = time.time()
+    return labels
+
+def get_value(obj, field, labels=None):
+    """Return obj[field], translated through labels ({value: label}) for choice columns."""
+    if not obj:
         return ""
-    s = str(g).strip().strip("{}").strip()
-    m = re.search(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}", s)
-    return m.group(0) if m else s
+    v = obj.get(field, "")
+    if not labels or v in (None, ""):
+        return v
+    if isinstance(v, str):
+        # Multi-select choices come back as "1,2,3"; join labels like FormattedValue does
+        return "; ".join(labels.get(int(x), x) if x.strip().isdigit() else x for x in v.split(","))
+    return labels.get(v, v)
 
 def normalize_multichoice(value: str) -> str:
     if not value:
@@ -83,6 +301,19 @@ def normalize_multichoice(value: str) -> str:
     parts = [p for p in parts if p]
     return ", ".join(parts)
 
+@lru_cache(maxsize=4096)
+def _calgary_from_iso(s: str) -> str:
+    """Convert a stripped ISO string; memoized since rows often share timestamps."""
+    try:
+        if s.endswith("Z"):
+            dt_utc = datetime.fromisoformat(s[:-1] + "+00:00")
+        else:
+            parsed = datetime.fromisoformat(s)
+            dt_utc = parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    except Exception:
+        return s
+    return dt_utc.astimezone(CALGARY_TZ).strftime(_STRFMT)
+
 def utc_to_calgary_str(dt_val) -> str:
     """
     Convert OData DateTimeOffset (UTC) to Calgary local 'MM/DD/YYYY HH:MM AM/PM'.
@@ -90,30 +321,129 @@ def utc_to_calgary_str(dt_val) -> str:
     """
     if not dt_val:
         return "NA"
-    # Parse input
     if isinstance(dt_val, str):
-        s = dt_val.strip()
-        try:
-            if s.endswith("Z"):
-                dt_utc = datetime.fromisoformat(s.replace("Z", "+00:00"))
-            else:
-                parsed = datetime.fromisoformat(s)
-                dt_utc = parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
-        except Exception:
-            return s
-    elif isinstance(dt_val, datetime):
+        return _calgary_from_iso(dt_val.strip())
+    if isinstance(dt_val, datetime):
         dt_utc = dt_val if dt_val.tzinfo else dt_val.replace(tzinfo=timezone.utc)
-    else:
-        return str(dt_val)
-    # Convert
-    local_dt = dt_utc.astimezone(CALGARY_TZ)
-    return local_dt.strftime("%m/%d/%Y %I:%M %p")
+        return dt_utc.astimezone(CALGARY_TZ).strftime(_STRFMT)
+    return str(dt_val)
+
+class ODataStreamError(Exception):
+    """Receiving or parsing a streamed OData response failed."""
+
+async def iter_odata_values(resp: httpx.Response, page: dict):
+    """
+    Yield records of an OData collection response as they are parsed off the wire.
+    The page's @odata.nextLink, if any, is stored in page["next_link"].
+    Transport and JSON failures are raised as ODataStreamError.
+    """
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events, use_float=True)
+    builder = None
+
+    def drain():
+        nonlocal builder
+        for prefix, event, value in events:
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == "value.item" and event == "end_map":
+                    yield builder.value
+                    builder = None
+            elif prefix == "value.item" and event == "start_map":
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix == "@odata.nextLink":
+                page["next_link"] = value
+        del events[:]
+
+    try:
+        async for chunk in resp.aiter_bytes():
+            parser.send(chunk)
+            for item in drain():
+                yield item
+        parser.close()
+        for item in drain():
+            yield item
+    except ijson.JSONError as e:
+        raise ODataStreamError("Failed to parse Dataverse JSON response.") from e
+    except httpx.HTTPError as e:
+        raise ODataStreamError(f"Dataverse query error: {e}") from e
+
+def _local_time_value(obj, field, labels=None):
+    # Use raw datetime values -> convert to Calgary local
+    return utc_to_calgary_str(obj.get(field))
+
+def _multichoice_value(obj, field, labels=None):
+    return normalize_multichoice(get_value(obj, field, labels))
+
+# Report columns in output order: (header, source entity, field, getter)
+_COLUMNS = (
+    ("Personal Health Number", "contact", "cp_ahcnumber", get_value),
+    ("Out of Province", "contact", "cp_clientoutofprovince", get_value),
+    ("Pseudo Name", "cp_cp_admission", "cp_pseudoname", get_value),
+    ("Service Request Date", "cp_cp_admission", "cp_servicerequestdate", _local_time_value),
+    ("Admission Date", "cp_cp_admission", "cp_admissiondate", _local_time_value),
+    ("Discharge Date", "cp_cp_admission", "cp_actualdischargedate", _local_time_value),
+    ("Postal Code", "contact", "address1_postalcode", get_value),
+    ("Gender", "contact", "cp_gender", get_value),
+    ("Age in Years", "contact", "cp_age", get_value),
+    ("Primary Substance", "cp_cp_admission", "cp_primarysubstanceused", get_value),
+    ("Other Substances", "cp_cp_admission", "cp_othersubstances", get_value),
+    ("Contributing Factors", "cp_cp_admission", "cp_contributingfactors", _multichoice_value),
+    ("Income Source", "cp_cp_admission", "cp_incomesource", get_value),
+    ("Opioid Agonist Therapy", "cp_substance", "cp_nameofsubstance", get_value),
+    ("Reason for Discharge", "cp_cp_admission", "cp_reasonfordischargemdrate", get_value),
+    ("Reason for Hospital Admission", "cp_cp_admission", "cp_reasonforhospitaladmissionmdrate", get_value),
+    ("Post-discharge Referrals", "cp_cp_admission", "cp_postdischargereferral", _multichoice_value),
+    ("MRP Client ID (for sites using MRP)", "contact", "cp_mrpnumber", get_value),
+)
+REPORT_HEADER = "\t".join(col[0] for col in _COLUMNS)
+
+# Position of each source entity in the per-row sources tuple built by format_admission
+_SOURCE_INDEX = {"cp_cp_admission": 0, "contact": 1, "cp_substance": 2}
+_EMPTY = {}
+
+def resolve_columns(option_labels):
+    """
+    Bind each report column to its label map from load_option_labels.
+    Call once per invocation; returns (source index, field, getter, labels) per column.
+    """
+    return tuple(
+        (_SOURCE_INDEX[entity], field, getter, option_labels.get(entity, _EMPTY).get(field))
+        for _, entity, field, getter in _COLUMNS
+    )
+
+def format_admission(rec, columns):
+    """
+    Build the tab-separated report line for one admission from resolve_columns output.
+    Returns (line, is_medical, is_social), or None if the admission is in neither report.
+    """
+    detoxtype = rec.get("cp_detoxtype")
+    med_disc = rec.get("cp_medicaldischargedate")
+    is_med = (detoxtype == 121570000) or (detoxtype == 121570001 and med_disc is not None)
+    is_soc = (detoxtype == 121570001) and (med_disc is None)
+    if not (is_med or is_soc):
+        return None
+
+    sources = (rec, rec.get("cp_Client") or _EMPTY, rec.get("cp_OpioidAgonistTherapy") or _EMPTY)
+    line = "\t".join(
+        fmt_cell(getter(sources[src], field, labels)) for src, field, getter, labels in columns
+    ) + "\n "
+    return line, is_med, is_soc
 
 # ----------------- Function -----------------
 
 @app.function_name(name="GetMDRATE")
 @app.route(route="getmdrate", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
-def get_mdrate(req: func.HttpRequest) -> func.HttpResponse:
+async def get_mdrate(req: func.HttpRequest) -> func.HttpResponse:
+    period = (req.params.get("period") or "last").strip().lower()
+    bounds_fn = PERIOD_BOUNDS.get(period)
+    if bounds_fn is None:
+        return func.HttpResponse(
+            f"Unknown period '{period}'; expected one of: {', '.join(PERIOD_BOUNDS)}",
+            status_code=400
+        )
+
     # Config / Auth
     try:
         tenant_id = os.environ["TENANT_ID"]
@@ -123,156 +453,79 @@ def get_mdrate(req: func.HttpRequest) -> func.HttpResponse:
     except KeyError as ke:
         return func.HttpResponse(f"Missing environment variable: {ke}", status_code=500)
 
-    cca = ConfidentialClientApplication(
-        client_id,
-        authority=f"https://login.microsoftonline.com/{tenant_id}",
-        client_credential=client_secret
+    # MSAL is synchronous; keep it off the event loop
+    token_result = await asyncio.to_thread(
+        acquire_token, tenant_id, client_id, client_secret, dataverse_url
     )
-    token_result = cca.acquire_token_for_client(scopes=[f"{dataverse_url}/.default"])
     if "access_token" not in token_result:
         return func.HttpResponse(
             f"Auth error: {token_result.get('error_description','Failed to acquire token')}",
             status_code=500
         )
     token = token_result["access_token"]
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/json",
-        "OData-MaxVersion": "4.0",
-        "OData-Version": "4.0",
-        "Prefer": 'odata.include-annotations="OData.Community.Display.V1.FormattedValue"'
-    }
+    # OData headers are client defaults; only the token varies per call
+    headers = {"Authorization": f"Bearer {token}"}
 
-    # Last month filter (UTC Z)
-    start_z, end_z = last_month_bounds_utc(datetime.now(timezone.utc))
-
-    # Admissions with $expand=cp_Client
-    admissions_select = ",".join([
-        "cp_servicerequestdate",
-        "cp_admissiondate",
-        "cp_actualdischargedate",
-        "cp_primarysubstanceused",
-        "cp_othersubstances",
-        "cp_contributingfactors",
-        "cp_incomesource",
-        "cp_reasonfordischargemdrate",
-        "cp_reasonforhospitaladmissionmdrate",
-        "cp_postdischargereferral",
-        "cp_detoxtype",
-        "cp_medicaldischargedate",
-        "cp_pseudoname",
-        "_cp_opioidagonisttherapy_value"
-    ])
-    contact_select = ",".join([
-        "cp_ahcnumber",
-        "cp_clientoutofprovince",
-        "address1_postalcode",
-        "cp_gender",
-        "cp_age",
-        "cp_mrpnumber"
-    ])
-    filter_str = f"cp_actualdischargedate ge {start_z} and cp_actualdischargedate lt {end_z}"
+    try:
+        columns = resolve_columns(await load_option_labels(dataverse_url, headers))
+    except Exception as e:
+        return func.HttpResponse(f"Dataverse metadata error: {e}", status_code=500)
+
+    # Reporting period filter (UTC Z)
+    start_z, end_z = bounds_fn(datetime.now(timezone.utc))
+
+    # Only medical (121570000) and social (121570001) detox types are reported
+    filter_str = (
+        f"cp_actualdischargedate ge {start_z} and cp_actualdischargedate lt {end_z}"
+        " and (cp_detoxtype eq 121570000 or cp_detoxtype eq 121570001)"
+    )
 
     admissions_url = f"{dataverse_url}/api/data/v9.2/cp_cp_admissions"
-    params = {
-        "$select": admissions_select,
-        "$filter": filter_str,
-        "$expand": f"cp_Client($select={contact_select})"
-    }
+    params = {"$select": _ADMISSIONS_SELECT, "$filter": filter_str, "$expand": _EXPAND}
 
-    try:
-        resp = requests.get(admissions_url, headers=headers, params=params)
-    except Exception as e:
-        return func.HttpResponse(f"Dataverse query error: {e}", status_code=500)
+    # Each page's nextLink embeds a paging cookie, so pages are fetched in order;
+    # rows are parsed and classified while the page is still streaming in
+    med_buf, soc_buf = io.StringIO(), io.StringIO()
+    for buf in (med_buf, soc_buf):
+        buf.write(REPORT_HEADER)
+        buf.write("\n ")
+    url = admissions_url
+    while url:
+        page = {}
+        try:
+            resp = await send_with_retry(
+                HTTP_CLIENT.build_request("GET", url, headers=headers, params=params), stream=True
+            )
+        except Exception as e:
+            return func.HttpResponse(f"Dataverse query error: {e}", status_code=500)
 
-    if resp.status_code != 200:
-        return func.HttpResponse(f"Dataverse query failed: {resp.text}", status_code=500)
+        try:
+            if resp.status_code != 200:
+                await resp.aread()
+                return func.HttpResponse(f"Dataverse query failed: {resp.text}", status_code=500)
 
-    try:
-        admissions = resp.json().get("value", [])
-    except Exception:
-        return func.HttpResponse("Failed to parse admissions JSON.", status_code=500)
-
-    # Substance name resolver
-    def fetch_substance_name(substance_guid):
-        guid = sanitize_guid(substance_guid)
-        if not guid:
-            return ""
-        list_url = f"{dataverse_url}/api/data/v9.2/cp_substances"
-        r = requests.get(
-            list_url,
-            headers=headers,
-            params={"$select": "cp_nameofsubstance", "$filter": f"cp_substanceid eq {guid}", "$top": "1"}
-        )
-        if r.status_code == 200:
-            try:
-                items = r.json().get("value", [])
-                return items[0].get("cp_nameofsubstance", "") if items else ""
-            except Exception:
-                return ""
-        return ""
+            async for rec in iter_odata_values(resp, page):
+                row = format_admission(rec, columns)
+                if row is None:
+                    continue
+                line, is_med, is_soc = row
+                if is_med:
+                    med_buf.write(line)
+                if is_soc:
+                    soc_buf.write(line)
+        except ODataStreamError as e:
+            # Only receiving/parsing is caught; row formatting errors propagate as-is
+            return func.HttpResponse(str(e), status_code=500)
+        finally:
+            await resp.aclose()
 
-    # Build rows
-    medical_rows, social_rows = [], []
-
-    for rec in admissions:
-        detoxtype = rec.get("cp_detoxtype")
-        med_disc = rec.get("cp_medicaldischargedate")
-        is_med = (detoxtype == 121570000) or (detoxtype == 121570001 and med_disc is not None)
-        is_soc = (detoxtype == 121570001) and (med_disc is None)
-        if not (is_med or is_soc):
-            continue
-
-        contact = rec.get("cp_Client") or {}
-        opioid_lookup_id = rec.get("_cp_opioidagonisttherapy_value")
-        opioid_name = fetch_substance_name(opioid_lookup_id)
-
-        # Normalize multi-choice labels
-        contributing = normalize_multichoice(get_value(rec, "cp_contributingfactors"))
-        post_referrals = normalize_multichoice(get_value(rec, "cp_postdischargereferral"))
-
-        # Use raw datetime values -> convert to Calgary local
-        srd_raw  = rec.get("cp_servicerequestdate")
-        adm_raw  = rec.get("cp_admissiondate")
-        disc_raw = rec.get("cp_actualdischargedate")
-
-        vals = [
-            get_value(contact, "cp_ahcnumber"),
-            get_value(contact, "cp_clientoutofprovince"),
-            get_value(rec, "cp_pseudoname"),
-            utc_to_calgary_str(srd_raw),
-            utc_to_calgary_str(adm_raw),
-            utc_to_calgary_str(disc_raw),
-            get_value(contact, "address1_postalcode"),
-            get_value(contact, "cp_gender"),
-            get_value(contact, "cp_age"),
-            get_value(rec, "cp_primarysubstanceused"),
-            get_value(rec, "cp_othersubstances"),
-            contributing,
-            get_value(rec, "cp_incomesource"),
-            opioid_name,
-            get_value(rec, "cp_reasonfordischargemdrate"),
-            get_value(rec, "cp_reasonforhospitaladmissionmdrate"),
-            post_referrals,
-            get_value(contact, "cp_mrpnumber")
-        ]
-        line = "\t".join(fmt_cell(v) for v in vals) + "\n "
-        if is_med:
-            medical_rows.append(line)
-        if is_soc:
-            social_rows.append(line)
-
-    header = (
-        "Personal Health Number\tOut of Province\tPseudo Name\tService Request Date\tAdmission Date\t"
-        "Discharge Date\tPostal Code\tGender\tAge in Years\tPrimary Substance\tOther Substances\t"
-        "Contributing Factors\tIncome Source\tOpioid Agonist Therapy\tReason for Discharge\t"
-        "Reason for Hospital Admission\tPost-discharge Referrals\tMRP Client ID (for sites using MRP)"
-    )
+        # nextLink already carries the query options
+        url, params = page.get("next_link"), None
 
-    medical_report = header + "\n " + ("".join(medical_rows) if medical_rows else "")
-    social_report  = header + "\n " + ("".join(social_rows)  if social_rows  else "")
+    medical_report = med_buf.getvalue()
+    social_report  = soc_buf.getvalue()
 
     return func.HttpResponse(
-        json.dumps({"medical_report": medical_report, "social_report": social_report}),
+        orjson.dumps({"medical_report": medical_report, "social_report": social_report}),
         mimetype="application/json"
     )